@@ -1,3 +1,242 @@
-from django.test import TestCase
+import json
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+import soundfile as sf
+import torch
+from django.test import RequestFactory, SimpleTestCase
+from huggingface_hub.utils import LocalEntryNotFoundError
+
+from . import views
+from .utils import (
+    CROSSFADE_SAMPLES, MAX_PHONEMES, download_with_retry, encode_text, infer_batch, pack_batches,
+    phonemize, save_audio, streaming_wav_header,
+)
+
+# Tests that load the Kokoro model (and download it on first run) are opt-in
+MODEL_TESTS = os.environ.get("KOKORO_MODEL_TESTS") == "1"
+
+
+class FakePipeline:
+    """Stands in for KPipeline's g2p/en_tokenize, yielding fixed phoneme chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def g2p(self, text):
+        return text, None
+
+    def en_tokenize(self, tokens):
+        for ps in self.chunks:
+            yield None, ps, None
+
+
+class PackBatchesTests(SimpleTestCase):
+    def test_batches_stay_under_token_budget(self):
+        phonemes = ["a" * n for n in (5, 300, 40, 12, 510, 80, 80, 200, 1)]
+        batches = pack_batches(phonemes, max_tokens=600)
+        for batch in batches:
+            padded = len(batch) * (max(len(phonemes[i]) for i in batch) + 2)
+            self.assertLessEqual(padded, 600)
+
+    def test_every_item_is_batched_once_in_length_order(self):
+        phonemes = ["a" * n for n in (30, 10, 20)]
+        batches = pack_batches(phonemes, max_tokens=4096)
+        self.assertEqual(batches, [[1, 2, 0]])
+
+    def test_oversized_item_gets_its_own_batch(self):
+        batches = pack_batches(["a" * 510, "a"], max_tokens=100)
+        self.assertEqual(batches, [[1], [0]])
+
+
+class PhonemizeTests(SimpleTestCase):
+    def test_long_chunk_splits_at_word_boundary(self):
+        words = ["abcdefghi"] * 80  # 799 phonemes with spaces
+        phonemes = phonemize(FakePipeline([" ".join(words)]), "ignored")
+        self.assertEqual(len(phonemes), 2)
+        for ps in phonemes:
+            self.assertLessEqual(len(ps), MAX_PHONEMES)
+            self.assertTrue(all(word == "abcdefghi" for word in ps.split(" ")))
+        self.assertEqual(" ".join(phonemes), " ".join(words))
+
+    def test_chunk_without_spaces_is_cut_at_limit(self):
+        phonemes = phonemize(FakePipeline(["a" * 600]), "ignored")
+        self.assertEqual([len(ps) for ps in phonemes], [MAX_PHONEMES, 600 - MAX_PHONEMES])
+
+    def test_empty_chunks_are_dropped(self):
+        self.assertEqual(phonemize(FakePipeline(["", "həlˈoʊ"]), "ignored"), ["həlˈoʊ"])
+
+
+class SaveAudioTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_path = os.path.join(tmp.name, "out.wav")
+
+    def test_timings_match_written_frames(self):
+        segments = [torch.full((n,), value, dtype=torch.int16) for n, value in ((2400, 1000), (1200, -1000), (100, 1000))]
+        chunk_timings, duration = save_audio(segments, self.output_path)
+        written, _ = sf.read(self.output_path, dtype='int16')
+        frames = written.shape[0]
+        # Each boundary overlaps by the crossfade, or the whole segment if shorter
+        self.assertEqual(frames, 2400 + 1200 + 100 - CROSSFADE_SAMPLES - 100)
+        self.assertEqual(chunk_timings[0]['start'], 0)
+        self.assertAlmostEqual(chunk_timings[-1]['end'], frames / 24000)
+        self.assertAlmostEqual(duration, frames / 24000)
+        for timing, segment in zip(chunk_timings, segments):
+            self.assertAlmostEqual(timing['end'] - timing['start'], segment.shape[0] / 24000)
+        # The first window ramps linearly from the first segment's level to the second's
+        fade_in = np.linspace(0, 1, CROSSFADE_SAMPLES)
+        window = written[2400 - CROSSFADE_SAMPLES:2400]
+        self.assertLessEqual(np.abs(window - (1000 * (1 - fade_in) - 1000 * fade_in)).max(), 1)
+        self.assertTrue((written[:2400 - CROSSFADE_SAMPLES] == 1000).all())
+        self.assertTrue((written[2400:2400 + 1200 - CROSSFADE_SAMPLES - 100] == -1000).all())
+
+    def test_single_segment_is_written_unchanged(self):
+        segment = torch.arange(-500, 500, dtype=torch.int16)
+        chunk_timings, duration = save_audio([segment], self.output_path)
+        written, _ = sf.read(self.output_path, dtype='int16')
+        self.assertEqual(written.tolist(), segment.tolist())
+        self.assertEqual(chunk_timings, [{'start': 0.0, 'end': 1000 / 24000}])
+
+    def test_no_segments_raises(self):
+        with self.assertRaises(RuntimeError):
+            save_audio([], self.output_path)
+
+
+class StreamingWavHeaderTests(SimpleTestCase):
+    def test_header_describes_16_bit_mono_pcm(self):
+        header = streaming_wav_header()
+        self.assertEqual(len(header), 44)
+        riff, _, wave, fmt, fmt_size, audio_format, channels, rate, byte_rate, block_align, bits, data, _ = (
+            struct.unpack('<4sI4s4sIHHIIHH4sI', header)
+        )
+        self.assertEqual((riff, wave, fmt, data), (b'RIFF', b'WAVE', b'fmt ', b'data'))
+        self.assertEqual((fmt_size, audio_format, channels, rate, byte_rate, block_align, bits), (16, 1, 1, 24000, 48000, 2, 16))
+
+
+def unreachable_hub():
+    """The error hf_hub_download raises when the Hub can't be reached and nothing is cached."""
+    error = LocalEntryNotFoundError("Cannot find the requested files in the disk cache")
+    error.__cause__ = requests.ConnectionError("connection refused")
+    return error
+
+
+@mock.patch("tts_app.utils.time.sleep")
+class DownloadWithRetryTests(SimpleTestCase):
+    def test_retries_when_hub_is_unreachable(self, sleep):
+        with mock.patch("tts_app.utils.hf_hub_download", side_effect=[unreachable_hub(), "/cache/voice.pt"]) as download:
+            self.assertEqual(download_with_retry(repo_id="repo", filename="voice.pt"), "/cache/voice.pt")
+        self.assertEqual(download.call_count, 2)
+        sleep.assert_called_once_with(1)
+
+    def test_retries_on_timeout(self, sleep):
+        with mock.patch("tts_app.utils.hf_hub_download", side_effect=[requests.Timeout(), "/cache/voice.pt"]) as download:
+            download_with_retry(repo_id="repo", filename="voice.pt")
+        self.assertEqual(download.call_count, 2)
+
+    def test_gives_up_after_all_tries(self, sleep):
+        with mock.patch("tts_app.utils.hf_hub_download", side_effect=unreachable_hub()) as download:
+            with self.assertRaises(LocalEntryNotFoundError):
+                download_with_retry(tries=3, repo_id="repo", filename="voice.pt")
+        self.assertEqual(download.call_count, 3)
+
+    def test_missing_file_is_not_retried(self, sleep):
+        with mock.patch("tts_app.utils.hf_hub_download", side_effect=LocalEntryNotFoundError("offline")) as download:
+            with self.assertRaises(LocalEntryNotFoundError):
+                download_with_retry(repo_id="repo", filename="voice.pt")
+        self.assertEqual(download.call_count, 1)
+        sleep.assert_not_called()
+
+
+def fake_synthesize(pipeline, texts, pack):
+    """Stands in for synthesize_texts, encoding each text's length in a silent segment."""
+    if pack == "broken":
+        raise RuntimeError("synthesis failed")
+    return [[torch.zeros(len(text), dtype=torch.int16)] for text in texts]
+
+
+@mock.patch("tts_app.views.cache_voice", side_effect=lambda voice: voice)
+@mock.patch("tts_app.views.synthesize_texts", side_effect=fake_synthesize)
+class RequestPoolTests(SimpleTestCase):
+    def setUp(self):
+        # A longer window makes sure each test's sentences land in one dispatch
+        patcher = mock.patch("tts_app.views.POOL_WINDOW", 0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        views.start_request_pool()
+
+    def test_voices_in_one_window_get_separate_buckets(self, synthesize, cache_voice):
+        sentences = [("One.", "af_heart"), ("Two.", "am_adam"), ("Three.", "af_heart")]
+        futures = [views.submit_sentence(text, voice) for text, voice in sentences]
+        for future in futures:
+            future.result(timeout=5)
+        batches = sorted((call.args[2], call.args[1]) for call in synthesize.call_args_list)
+        self.assertEqual(batches, [("af_heart", ["One.", "Three."]), ("am_adam", ["Two."])])
+
+    def test_failing_bucket_only_fails_its_own_sentences(self, synthesize, cache_voice):
+        broken = views.submit_sentence("Fails.", "broken")
+        working = views.submit_sentence("Works.", "af_heart")
+        with self.assertRaises(RuntimeError):
+            broken.result(timeout=5)
+        self.assertEqual(working.result(timeout=5)[0].shape[0], len("Works."))
+
+    @mock.patch("tts_app.views.kokoro_pipeline", object())
+    @mock.patch("tts_app.views.save_audio", side_effect=lambda segments, path: ([], segments[0].shape[0]))
+    def test_generate_returns_results_in_request_order(self, save_audio, synthesize, cache_voice):
+        texts = ["Hi.", "Hello there.", "Hey you, over there."]
+        voices = ["af_heart", "am_adam", "af_heart"]
+        request = RequestFactory().post("/generate/", {"text[]": texts, "voice[]": voices})
+        response = views.generate(request)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)["audio_urls"]
+        self.assertEqual([(r["voice"], r["duration"]) for r in results], [(v, len(t)) for t, v in zip(texts, voices)])
+
+
+@unittest.skipUnless(MODEL_TESTS, "set KOKORO_MODEL_TESTS=1 to run tests against the Kokoro model")
+class BatchedInferenceTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from kokoro import KPipeline
+        cls.pipeline = KPipeline(lang_code='a', device='cpu')
+        cls.pack = cls.pipeline.load_voice("af_heart")
+
+    def reference(self, ps):
+        """Single-item output of KModel.forward_with_tokens, quantized like infer_batch."""
+        model = self.pipeline.model
+        ids = [i for i in map(model.vocab.get, ps) if i is not None]
+        audio, _ = model.forward_with_tokens(torch.LongTensor([[0, *ids, 0]]), self.pack[len(ps) - 1])
+        return audio.clamp(-1, 1).mul(32767).to(torch.int16)
+
+    def test_short_item_matches_unbatched_forward(self):
+        short = phonemize(self.pipeline, "Hi there.")[0]
+        long = phonemize(self.pipeline, "This much longer sentence pads the short one out to its own length.")[0]
+        batched = infer_batch(self.pipeline, [short, long], self.pack)
+        expected = self.reference(short)
+        self.assertEqual(batched[0].shape, expected.shape)
+        self.assertLessEqual((batched[0].int() - expected.int()).abs().max().item(), 8)
+
+
+@unittest.skipUnless(MODEL_TESTS and torch.cuda.is_available(), "needs KOKORO_MODEL_TESTS=1 and a CUDA device")
+class BertGraphTests(SimpleTestCase):
+    def test_replay_matches_eager_across_calls(self):
+        from kokoro import KPipeline
+        pipeline = KPipeline(lang_code='a', device='cuda')
+        pack = pipeline.load_voice("af_heart").cuda()
+        model = pipeline.model
+        # The first call captures the graph; the second replays it after the first call's autocast has exited
+        infer_batch(pipeline, phonemize(pipeline, "Capturing the graph."), pack)
+        infer_batch(pipeline, phonemize(pipeline, "Replaying it later on."), pack)
+
+        input_ids = torch.LongTensor([[0, 50, 83, 54, 156, 57, 135, 0]]).cuda()
+        text_mask = torch.zeros_like(input_ids, dtype=torch.bool)
+        with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16):
+            replayed = encode_text(model, input_ids, text_mask).float().clone()
+            eager = model.bert_encoder(model.bert(input_ids, attention_mask=(~text_mask).int())).float()
+        torch.testing.assert_close(replayed, eager, atol=1e-2, rtol=1e-2)
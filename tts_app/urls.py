@@ -4,4 +4,5 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('generate/', views.generate, name='generate_speech'),  # ✅ fixed here
+    path('generate/stream/', views.generate_stream, name='generate_speech_stream'),
 ]
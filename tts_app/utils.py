@@ -1,83 +1,398 @@
+import numpy as np
 import torch
 import soundfile as sf
+import functools
 import os
 import misaki.espeak as espeak
 import logging
+import requests
+import time
 from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import LocalEntryNotFoundError
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 import re
+import struct
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on padded tokens (batch size x longest sequence) per forward pass
+MAX_BATCH_TOKENS = 4096
+
+MODEL_REPO = "hexgrad/Kokoro-82M"
+
+# Where espeak-ng keeps its data on the platforms we run on; ESPEAK_DATA_PATH takes precedence
+ESPEAK_DATA_PATHS = [
+    "/usr/share/espeak-ng-data",
+    "/usr/lib/x86_64-linux-gnu/espeak-ng-data",  # Debian/Ubuntu espeak-ng package
+    "/usr/local/share/espeak-ng-data",
+    r"C:\Program Files\eSpeak NG\espeak-ng-data",
+]
+
+def find_espeak_data_path():
+    """Return the first existing espeak-ng data directory."""
+    candidates = [os.environ.get("ESPEAK_DATA_PATH")] + ESPEAK_DATA_PATHS
+    for path in candidates:
+        if path and os.path.isdir(path):
+            return path
+    raise FileNotFoundError(f"espeak-ng data path not found, tried: {[p for p in candidates if p]}")
+
+# Resolve and set the espeak-ng data path once at import; requests never touch it again
+ESPEAK_PATH = find_espeak_data_path()
+os.environ["ESPEAK_DATA_PATH"] = ESPEAK_PATH
+espeak.EspeakWrapper.data_path = ESPEAK_PATH
+logger.debug(f"Successfully set espeak-ng data path: {ESPEAK_PATH}")
+
+# Kokoro's context limit in phonemes (the voice packs hold one style per length)
+MAX_PHONEMES = 510
+
+# Overlap between consecutive segments, 10 ms at 24kHz, to hide chunk boundaries
+CROSSFADE_SAMPLES = 240
+
+# CUDA graphs of the BERT stage are bucketed by padded length (and batch size)
+GRAPH_LENGTHS = (32, 64, 128, 256, 512)
+GRAPH_CAPTURE_TRIES = 3  # Failed captures per shape before it always runs eagerly
+
+# Split on: spaces after [.!?], double spaces after word, or newlines
+_SENT_RE = re.compile(r'(?<=[.!?])\s+|(?<=\w)\s{2,}|\n+')
+
 def split_sentences(text):
     """Split text into sentences, matching index.html logic."""
-    # Split on: spaces after [.!?], double spaces after word, or newlines
-    pattern = r'(?<=[.!?])\s+|(?<=\w)\s{2,}|\n+'
-    sentences = [s.strip() for s in re.split(pattern, text) if s.strip()]
-    return sentences if sentences else [text.strip()]
-
-def generate_speech(text, voice, output_path, pipeline):
-    """Generate speech for a single sentence using a cached pipeline."""
-    # Set espeak-ng data path
-    espeak_data_path = r"C:\Program Files\eSpeak NG\espeak-ng-data"
-    if not os.path.exists(espeak_data_path):
-        logger.error(f"espeak-ng data path not found: {espeak_data_path}")
-        raise FileNotFoundError(f"espeak-ng data path not found at {espeak_data_path}")
-
-    try:
-        espeak.EspeakWrapper.data_path = espeak_data_path
-        logger.debug(f"Successfully set espeak-ng data path: {espeak_data_path}")
-    except Exception as e:
-        logger.error(f"Failed to set espeak-ng data path: {str(e)}")
-        raise
-
-    try:
-        local_voice_path = os.path.join(os.path.dirname(__file__), '..', 'Kokoro-82M', 'voices', f"{voice}.pt")
-        if not os.path.exists(local_voice_path):
-            logger.warning(f"Voice file {voice}.pt not found locally, downloading")
-            hf_hub_download(repo_id="hexgrad/Kokoro-82M", filename=f"voices/{voice}.pt", local_dir=os.path.dirname(local_voice_path))
-
-        # Split into sentences
-        sentences = split_sentences(text)
-        audio_segments = []
-        chunk_timings = []
-        current_time = 0.0
+    return [s for s in (p.strip() for p in _SENT_RE.split(text)) if s] or [text.strip()]
+
+def phonemize(pipeline, text):
+    """Convert text to phoneme strings, one per chunk that fits the model context."""
+    _, tokens = pipeline.g2p(text)
+    phonemes = []
+    for _, ps, _ in pipeline.en_tokenize(tokens):
+        # Split anything still over the context limit at the nearest word boundary
+        while len(ps) > MAX_PHONEMES:
+            cut = ps.rfind(' ', 0, MAX_PHONEMES + 1)
+            if cut <= 0:
+                cut = MAX_PHONEMES
+            phonemes.append(ps[:cut].strip())
+            ps = ps[cut:].strip()
+        if ps:
+            phonemes.append(ps)
+    return phonemes
+
+def _bucket(n, sizes):
+    """Smallest size in sizes that fits n, or None."""
+    return next((size for size in sizes if size >= n), None)
+
+def _capture_bert_graph(model, batch_size, length):
+    """Capture bert + bert_encoder for one padded (batch_size, length) shape.
+
+    Autocast's weight cast cache is disabled for warmup and capture: the graph
+    would otherwise read fp16 weight copies that are freed when the caller's
+    autocast context exits, and every later replay would read reused memory.
+    """
+    device = model.device
+    static_ids = torch.zeros(batch_size, length, dtype=torch.long, device=device)
+    static_mask = torch.zeros(batch_size, length, dtype=torch.int, device=device)
+    static_mask[:, 0] = 1  # Keep filler rows from attending to nothing
+
+    with torch.autocast(device_type='cuda', dtype=torch.float16, cache_enabled=False):
+        # Warm up on a side stream so lazy allocations happen outside the capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                model.bert_encoder(model.bert(static_ids, attention_mask=static_mask))
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = model.bert_encoder(model.bert(static_ids, attention_mask=static_mask))
+    return graph, static_ids, static_mask, static_out
+
+def encode_text(model, input_ids, text_mask):
+    """Run bert + bert_encoder, replaying a captured CUDA graph when the shape fits a bucket.
+
+    Inputs are padded up to the bucket; attention masking keeps the real
+    positions identical to an eager run. Returns (batch, length, hidden).
+    """
+    batch_size, length = input_ids.shape
+    attention_mask = (~text_mask).int()
+    bucket_len = _bucket(length, GRAPH_LENGTHS)
+    if input_ids.device.type != 'cuda' or bucket_len is None:
+        return model.bert_encoder(model.bert(input_ids, attention_mask=attention_mask))
+
+    # Graphs live on the model they were captured from, so separate pipelines never share them
+    graphs = vars(model).setdefault('_bert_graphs', {})
+    failures = vars(model).setdefault('_bert_graph_failures', {})
+    key = (1 << (batch_size - 1).bit_length(), bucket_len)
+    if key not in graphs and failures.get(key, 0) < GRAPH_CAPTURE_TRIES:
+        try:
+            graphs[key] = _capture_bert_graph(model, *key)
+            logger.debug(f"Captured BERT CUDA graph for batch {key[0]}, length {key[1]}")
+        except Exception as e:
+            # Often transient (e.g. other work on the device mid-capture), so retry on a later call
+            failures[key] = failures.get(key, 0) + 1
+            logger.warning(f"CUDA graph capture {failures[key]}/{GRAPH_CAPTURE_TRIES} failed for {key}, running eagerly: {e}")
+    if key not in graphs:
+        return model.bert_encoder(model.bert(input_ids, attention_mask=attention_mask))
+
+    graph, static_ids, static_mask, static_out = graphs[key]
+    static_ids.zero_()
+    static_ids[:batch_size, :length].copy_(input_ids)
+    static_mask.zero_()
+    static_mask[:, 0] = 1
+    static_mask[:batch_size, :length].copy_(attention_mask)
+    graph.replay()
+    return static_out[:batch_size, :length]
+
+def forward_batch(model, input_ids, input_lengths, text_mask, ref_s, speed=1):
+    """Padded-batch version of KModel.forward_with_tokens.
+
+    text_mask is True on padding positions. input_lengths stays on the CPU, since
+    only LSTM packing (here and in Kokoro's encoders) reads it. Text and duration
+    stages run on the padded batch; F0/energy prediction and the decoder run per
+    item on its own frames, since their BiLSTM and instance norms would otherwise
+    see the padding.
+    Returns one 1-D audio tensor per item.
+    """
+    d_en = encode_text(model, input_ids, text_mask).transpose(-1, -2)
+    s = ref_s[:, 128:]
+    d = model.predictor.text_encoder(d_en, s, input_lengths, text_mask)
+    x = pack_padded_sequence(d, input_lengths, batch_first=True, enforce_sorted=False)
+    x, _ = model.predictor.lstm(x)
+    x, _ = pad_packed_sequence(x, batch_first=True, total_length=input_ids.shape[1])
+    duration = model.predictor.duration_proj(x)
+    duration = torch.sigmoid(duration).sum(axis=-1) / speed
+    pred_dur = torch.round(duration).clamp(min=1).long().masked_fill(text_mask, 0)
+
+    # Alignment matrix: token j covers frames [starts[j], ends[j]) of its item
+    ends = pred_dur.cumsum(dim=1)
+    starts = ends - pred_dur
+    # Read frame counts back now, while the device has to sync for the alignment size anyway
+    frames = ends[:, -1].tolist()
+    t = torch.arange(max(frames), device=input_ids.device)
+    pred_aln_trg = ((t >= starts.unsqueeze(-1)) & (t < ends.unsqueeze(-1))).float()
+
+    en = d.transpose(-1, -2) @ pred_aln_trg
+    t_en = model.text_encoder(input_ids, input_lengths, text_mask)
+    asr = t_en @ pred_aln_trg
+
+    audio = []
+    for i, n in enumerate(frames):
+        F0_pred, N_pred = model.predictor.F0Ntrain(en[i:i + 1, :, :n], s[i:i + 1])
+        # The decoder's iSTFT uses a non power-of-two FFT size, which cuFFT cannot run in half precision
+        with torch.autocast(device_type=input_ids.device.type, enabled=False):
+            audio.append(model.decoder(
+                asr[i:i + 1, :, :n].float(), F0_pred.float(), N_pred.float(), ref_s[i:i + 1, :128].float()
+            ).squeeze())
+    return audio
+
+def infer_batch(pipeline, phonemes, pack):
+    """Synthesize several phoneme strings for one voice pack in a single forward pass.
 
+    Returns one 1-D int16 PCM tensor per phoneme string, in input order, still on
+    the model device. Quantizing here halves the bytes later copied to the host.
+    """
+    model = pipeline.model
+    device = model.device
+    vocab = model.vocab
+    input_ids = [
+        torch.LongTensor([0, *(i for i in map(vocab.get, ps) if i is not None), 0])
+        for ps in phonemes
+    ]
+    input_lengths = torch.LongTensor([ids.shape[0] for ids in input_ids])
+    input_ids = pad_sequence(input_ids, batch_first=True)
+    batch_size, max_len = input_ids.shape
+    text_mask = torch.arange(max_len).unsqueeze(0).expand(batch_size, -1) >= input_lengths.unsqueeze(1)
+
+    # The voice pack holds one style vector per phoneme length
+    ref_s = pack[[len(ps) - 1 for ps in phonemes]].squeeze(1)
+
+    use_amp = device.type == 'cuda'
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
+        audio = forward_batch(
+            model, input_ids.to(device), input_lengths, text_mask.to(device), ref_s.to(device)
+        )
+        return [segment.clamp_(-1, 1).mul_(32767).to(torch.int16) for segment in audio]
+
+def copy_to_host(segments, copy_stream):
+    """Queue device-to-host copies of segments into one pinned buffer on copy_stream.
+
+    Returns host views of the buffer; they are only valid after copy_stream is synchronized.
+    """
+    total = sum(segment.shape[0] for segment in segments)
+    host_buf = torch.empty(total, dtype=segments[0].dtype, pin_memory=True)
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    views = []
+    offset = 0
+    with torch.cuda.stream(copy_stream):
+        for segment in segments:
+            n = segment.shape[0]
+            host_buf[offset:offset + n].copy_(segment, non_blocking=True)
+            segment.record_stream(copy_stream)
+            views.append(host_buf[offset:offset + n])
+            offset += n
+    return views
+
+def compile_model(pipeline):
+    """Compile the model's decoder and text encoder with torch.compile (PyTorch >= 2.2).
+
+    Default mode is used rather than reduce-overhead: the latter's CUDA graphs reuse
+    output buffers between calls, while synthesize_texts keeps earlier batches alive.
+    """
+    version = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+    if version < (2, 2):
+        logger.warning(f"torch.compile needs PyTorch >= 2.2, found {torch.__version__}; skipping")
+        return
+    model = pipeline.model
+    model.decoder = torch.compile(model.decoder, dynamic=True, fullgraph=False)
+    model.text_encoder = torch.compile(model.text_encoder, dynamic=True, fullgraph=False)
+    logger.debug("Compiled Kokoro decoder and text encoder")
+
+def pack_batches(phonemes, max_tokens=MAX_BATCH_TOKENS):
+    """Group phoneme-string indices into length-sorted batches under a padded token budget."""
+    order = sorted(range(len(phonemes)), key=lambda i: len(phonemes[i]))
+    batches = []
+    batch = []
+    for i in order:
+        # Sorted ascending, so the incoming item sets the padded length (+2 for BOS/EOS)
+        if batch and (len(batch) + 1) * (len(phonemes[i]) + 2) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def synthesize_texts(pipeline, texts, pack, max_tokens=MAX_BATCH_TOKENS):
+    """Synthesize several texts with one voice pack, batching sentences across texts.
+
+    Returns a list of audio segment lists, one per text, in input order.
+    """
+    chunks = []  # (text index, phonemes)
+    for t, text in enumerate(texts):
+        sentences = split_sentences(text)
         for i, sentence in enumerate(sentences):
-            sentence = sentence.strip()
-            if not sentence:
-                continue
             try:
-                generator = pipeline(sentence, voice=voice)
-                for _, _, audio in generator:
-                    logger.debug(f"Generated audio tensor for sentence {i+1}/{len(sentences)} on device: {audio.device}")
-                    audio_segments.append(audio)
-                    chunk_duration = audio.shape[0] / 24000  # 24kHz sample rate
-                    chunk_timings.append({
-                        'start': current_time,
-                        'end': current_time + chunk_duration
-                    })
-                    current_time += chunk_duration
-                    logger.debug(f"Processed sentence {i+1}/{len(sentences)}: '{sentence}'")
+                chunks.extend((t, ps) for ps in phonemize(pipeline, sentence))
+                logger.debug(f"Phonemized sentence {i+1}/{len(sentences)}: '{sentence}'")
             except Exception as e:
                 logger.warning(f"Skipping sentence due to error: '{sentence}' — {e}")
-                continue  # Skip to next sentence instead of raising
-
-        # Save full audio
-        if audio_segments:
-            full_audio = torch.cat(audio_segments, dim=0).cpu().numpy()
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            sf.write(output_path, full_audio, 24000)
-            logger.info(f"Full audio written to {output_path}")
-        else:
-            raise RuntimeError("No audio segments generated")
-
-        # Confirm actual audio duration
-        with sf.SoundFile(output_path) as f:
-            actual_duration = f.frames / f.samplerate
-        logger.debug(f"Final audio duration: {actual_duration:.2f}s")
-
-        return audio_segments, chunk_timings, actual_duration
-
-    except Exception as e:
-        logger.error(f"Error during audio generation: {str(e)}")
-        raise
\ No newline at end of file
+
+    phonemes = [ps for _, ps in chunks]
+    audio = [None] * len(chunks)
+    batches = pack_batches(phonemes, max_tokens)
+    # On GPU, copy each batch back on a side stream so the transfer overlaps the next batch
+    copy_stream = torch.cuda.Stream() if pipeline.model.device.type == 'cuda' else None
+    for batch in batches:
+        try:
+            outputs = [(batch, infer_batch(pipeline, [phonemes[i] for i in batch], pack))]
+        except Exception as e:
+            # Retry one at a time so a bad sentence (or an oversized batch) only drops itself
+            logger.warning(f"Batch of {len(batch)} failed, retrying items one at a time — {e}")
+            if copy_stream is not None:
+                torch.cuda.empty_cache()
+            outputs = []
+            for i in batch:
+                try:
+                    outputs.append(([i], infer_batch(pipeline, [phonemes[i]], pack)))
+                except Exception as e:
+                    logger.warning(f"Skipping sentence due to error: '{phonemes[i]}' — {e}")
+        for part, output in outputs:
+            if copy_stream is not None:
+                output = copy_to_host(output, copy_stream)
+            for i, segment in zip(part, output):
+                audio[i] = segment
+    if copy_stream is not None:
+        copy_stream.synchronize()
+    logger.debug(f"Generated {len(chunks)} audio segments in {len(batches)} batches")
+
+    segments = [[] for _ in texts]
+    for (t, _), segment in zip(chunks, audio):
+        if segment is not None:
+            segments[t].append(segment)
+    return segments
+
+_NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+def _is_transient(error):
+    """Whether a download error came from failing to reach the Hub."""
+    if isinstance(error, _NETWORK_ERRORS):
+        return True
+    # With no cached copy, hf_hub_download reports an unreachable Hub as LocalEntryNotFoundError
+    return isinstance(error, LocalEntryNotFoundError) and isinstance(error.__cause__, _NETWORK_ERRORS)
+
+def download_with_retry(tries=3, **kwargs):
+    """hf_hub_download with exponential backoff on network errors only."""
+    for attempt in range(tries):
+        try:
+            return hf_hub_download(**kwargs)
+        except (*_NETWORK_ERRORS, LocalEntryNotFoundError) as e:
+            if attempt == tries - 1 or not _is_transient(e):
+                raise
+            logger.warning(f"Download of {kwargs.get('filename')} failed ({e}), retrying in {2 ** attempt}s")
+            time.sleep(2 ** attempt)
+
+@functools.lru_cache(maxsize=None)
+def ensure_voice(voice):
+    """Return the path of a voice file in the Hugging Face cache, downloading it on first use."""
+    return download_with_retry(repo_id=MODEL_REPO, filename=f"voices/{voice}.pt")
+
+def load_voice_pack(pipeline, voice):
+    """Load a voice pack onto the model's device."""
+    return pipeline.load_voice(ensure_voice(voice)).to(pipeline.model.device, non_blocking=True)
+
+def streaming_wav_header(sample_rate=24000):
+    """16-bit mono WAV header with a maximal data size, for responses of unknown length."""
+    data_size = 0xFFFFFFFF - 36
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', data_size + 36, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size,
+    )
+
+def crossfade(audio_segments, overlaps=None):
+    """Join int16 segments with a linear crossfade over CROSSFADE_SAMPLES, yielding numpy chunks.
+
+    audio_segments may be any iterable and is consumed lazily, so this also works
+    for streamed output. The overlap used in front of each segment is appended to
+    overlaps when given.
+    """
+    pending = None  # Unwritten tail of the previous segment
+    for audio in audio_segments:
+        n = 0
+        if pending is not None:
+            n = min(CROSSFADE_SAMPLES, pending.shape[0], audio.shape[0])
+            fade_in = torch.linspace(0, 1, n, device=audio.device)
+            blend = pending[pending.shape[0] - n:].float() * (1 - fade_in) + audio[:n].float() * fade_in
+            yield pending[:pending.shape[0] - n].cpu().numpy()
+            yield blend.round_().to(torch.int16).cpu().numpy()
+            audio = audio[n:]
+        if overlaps is not None:
+            overlaps.append(n)
+        pending = audio
+    if pending is not None:
+        yield pending.cpu().numpy()
+
+def save_audio(audio_segments, output_path):
+    """Write int16 audio segments to a single wav file and return (chunk_timings, duration)."""
+    if not audio_segments:
+        raise RuntimeError("No audio segments generated")
+
+    # Stream segments straight to a 16-bit PCM wav instead of concatenating first,
+    # crossfading each boundary over CROSSFADE_SAMPLES
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    overlaps = []
+    with sf.SoundFile(output_path, 'w', samplerate=24000, channels=1, subtype='PCM_16') as f:
+        for chunk in crossfade(audio_segments, overlaps):
+            f.write(chunk)
+    logger.info(f"Full audio written to {output_path}")
+
+    # Each segment starts where the previous one ended, pulled back by its crossfade overlap
+    lens = np.fromiter((audio.shape[0] for audio in audio_segments), dtype=np.float64, count=len(audio_segments))
+    ends = (lens - np.asarray(overlaps, dtype=np.float64)).cumsum() / 24000  # 24kHz sample rate
+    starts = ends - lens / 24000
+    chunk_timings = [{'start': float(start), 'end': float(end)} for start, end in zip(starts, ends)]
+
+    # The last segment ends exactly where the written audio does
+    actual_duration = float(ends[-1])
+    logger.debug(f"Final audio duration: {actual_duration:.2f}s")
+
+    return chunk_timings, actual_duration
\ No newline at end of file
@@ -1,13 +1,16 @@
+import itertools
 import logging
 import os
+import queue
+import secrets
+import threading
 import time
+from concurrent.futures import Future
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from .utils import generate_speech
+from .utils import MODEL_REPO, compile_model, crossfade, download_with_retry, ensure_voice, infer_batch, load_voice_pack, phonemize, save_audio, split_sentences, streaming_wav_header, synthesize_texts
 import torch
-from huggingface_hub import hf_hub_download
-from retry import retry
 from pathlib import Path
 import warnings
 
@@ -19,10 +22,30 @@ logger = logging.getLogger(__name__)
 
 # Global pipeline and voice cache
 kokoro_pipeline = None
-voice_cache = {}  # Maps voice_name to local voice file path
-MODEL_REPO = "hexgrad/Kokoro-82M"
+voice_cache = {}  # Maps voice_name to its voice pack tensor on the model device
 MODEL_PATH = "kokoro-v1_0.pth"
-VOICE_DIR = os.path.join(os.path.dirname(__file__), '..', 'Kokoro-82M', 'voices')
+COMPILE_MODEL = os.environ.get("KOKORO_COMPILE", "0") == "1"  # Opt in to torch.compile
+# Short, medium and long inputs so warmup covers the typical range of sequence lengths
+WARMUP_TEXTS = [
+    "Hello world.",
+    "This is a slightly longer sentence used to warm up the speech model.",
+    "When the page is long, readers paste whole paragraphs, so the model also sees "
+    "sequences of a few hundred phonemes and should have those shapes ready as well.",
+]
+
+# Request pool: a single worker drains queued sentences into dynamic batches
+POOL_WINDOW = 0.02  # Seconds to wait for more sentences before dispatching a batch
+POOL_MAX_ITEMS = 64  # Max sentences taken off the queue per dispatch
+request_queue = queue.Queue()  # Items are (text, voice, future)
+pool_worker = None
+RESULT_TIMEOUT = 300  # Seconds a request waits on the pool before giving up
+
+# Guard one-time setup against concurrent first requests
+_init_lock = threading.Lock()
+_pool_lock = threading.Lock()
+_voice_lock = threading.Lock()
+
+_file_ctr = itertools.count()  # Makes output filenames unique within the process
 
 def initialize_kokoro_pipeline():
     """Initialize and cache the Kokoro pipeline."""
@@ -31,54 +54,127 @@ def initialize_kokoro_pipeline():
         logger.debug("Using cached Kokoro pipeline")
         return
 
+    with _init_lock:
+        # Another request may have finished initializing while we waited
+        if kokoro_pipeline is not None:
+            return
+
+        start_time = time.time()
+        try:
+            # Download model file into the Hugging Face cache, which KPipeline reads it from
+            local_model_path = download_with_retry(repo_id=MODEL_REPO, filename=MODEL_PATH)
+            logger.debug(f"Cached model at {local_model_path}")
+
+            # Initialize pipeline
+            from kokoro import KPipeline
+            pipeline = KPipeline(lang_code='a')
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            logger.debug(f"Initialized KPipeline (device managed internally, detected: {device})")
+
+            if COMPILE_MODEL:
+                compile_model(pipeline)
+
+            # Warm-start with dummy inferences so the first request skips lazy CUDA/cuDNN setup and compilation
+            pack = cache_voice("af_heart", pipeline)
+            for text in WARMUP_TEXTS:
+                infer_batch(pipeline, phonemize(pipeline, text), pack)
+            logger.debug("Warmed up Kokoro pipeline")
+
+            # Publish the pipeline only once it is ready, then let the worker use it
+            kokoro_pipeline = pipeline
+            start_request_pool()
+
+            logger.info(f"Kokoro pipeline initialized in {time.time() - start_time:.2f}s")
+        except Exception as e:
+            logger.error(f"Failed to initialize Kokoro pipeline: {str(e)}")
+            kokoro_pipeline = None
+            raise
+
+def cache_voice(voice, pipeline=None):
+    """Return the voice pack for a voice, loading it onto the model device on first use."""
+    with _voice_lock:
+        if voice not in voice_cache:
+            voice_cache[voice] = load_voice_pack(pipeline or kokoro_pipeline, voice)
+            logger.debug(f"Cached voice {voice} on {voice_cache[voice].device}")
+        return voice_cache[voice]
+
+def start_request_pool():
+    """Start the background worker that batches queued sentences."""
+    global pool_worker
+    with _pool_lock:
+        if pool_worker is not None:
+            return
+        pool_worker = threading.Thread(target=run_request_pool, name="kokoro-request-pool", daemon=True)
+        pool_worker.start()
+    logger.debug("Started request pool worker")
+
+def run_request_pool():
+    """Collect queued sentences for up to POOL_WINDOW seconds, then synthesize them per voice."""
+    while True:
+        items = [request_queue.get()]
+        deadline = time.monotonic() + POOL_WINDOW
+        while len(items) < POOL_MAX_ITEMS:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        buckets = {}
+        for item in items:
+            buckets.setdefault(item[1], []).append(item)
+        for voice, bucket in buckets.items():
+            process_voice_bucket(voice, bucket)
+
+def process_voice_bucket(voice, items):
+    """Synthesize (text, voice, future) items sharing a voice, resolving each future with its int16 segments.
+
+    Callers write their own files, so the single worker only ever runs inference.
+    """
     start_time = time.time()
     try:
-        # Set espeak-ng data path
-        espeak_path = r"C:\Program Files\eSpeak NG\espeak-ng-data"
-        os.environ["ESPEAK_DATA_PATH"] = espeak_path
-        logger.debug(f"Set espeak-ng data path: {espeak_path}")
-
-        # Download and cache model file
-        local_model_path = hf_hub_download(repo_id=MODEL_REPO, filename=MODEL_PATH, local_dir="models")
-        logger.debug(f"Cached model at {local_model_path}")
-
-        # Initialize pipeline
-        from kokoro import KPipeline
-        kokoro_pipeline = KPipeline(lang_code='a')
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.debug(f"Initialized KPipeline (device managed internally, detected: {device})")
-
-        logger.info(f"Kokoro pipeline initialized in {time.time() - start_time:.2f}s")
+        pack = cache_voice(voice)
+        segments = synthesize_texts(kokoro_pipeline, [text for text, _, _ in items], pack)
     except Exception as e:
-        logger.error(f"Failed to initialize Kokoro pipeline: {str(e)}")
-        kokoro_pipeline = None
-        raise
+        logger.error(f"Error generating audio for {len(items)} sentences with voice {voice}: {str(e)}")
+        for _, _, future in items:
+            future.set_exception(e)
+        return
 
-@retry(tries=3, delay=1, backoff=2, logger=logger)
-def generate_audio_for_sentence(text, voice, output_path):
-    """Generate audio for a single sentence with retry logic."""
-    global kokoro_pipeline
-    start_time = time.time()
-    if not kokoro_pipeline:
-        initialize_kokoro_pipeline()
-
-    if voice not in voice_cache:
-        voice_file = f"{voice}.pt"
-        local_voice_path = os.path.join(VOICE_DIR, voice_file)
-        if not os.path.exists(local_voice_path):
-            logger.debug(f"Downloading voice {voice}")
-            hf_hub_download(repo_id=MODEL_REPO, filename=f"voices/{voice_file}", local_dir=VOICE_DIR)
-        voice_cache[voice] = local_voice_path
-        logger.debug(f"Cached voice {voice} at {local_voice_path}")
+    for (_, _, future), audio_segments in zip(items, segments):
+        future.set_result(audio_segments)
+    logger.debug(f"Generated audio for {len(items)} sentences with voice {voice} in {time.time() - start_time:.2f}s")
 
+def submit_sentence(text, voice):
+    """Queue a sentence for the request pool and return a Future for its audio segments."""
+    future = Future()
+    request_queue.put((text, voice, future))
+    return future
+
+def stream_audio_for_text(text, voice, first_segments, futures):
+    """Yield a WAV header, then the text's int16 PCM sentence by sentence.
+
+    first_segments is the already-synthesized first sentence; futures cover the
+    remaining sentences, queued together so the pool batches them while the first
+    one plays. Segments are joined with the same crossfade save_audio applies, so
+    the audio matches /generate/ for the same text.
+    """
+    def segments():
+        yield from first_segments
+        for future in futures:
+            yield from future.result(timeout=RESULT_TIMEOUT)
+
+    yield streaming_wav_header()
+    start_time = time.time()
     try:
-        audio_segments, chunk_timings, duration = generate_speech(text, voice, output_path, kokoro_pipeline)
-        audio_url = f"/static/audio/{os.path.basename(output_path)}"
-        logger.debug(f"Generated audio for '{text[:50]}...' with voice {voice} in {time.time() - start_time:.2f}s")
-        return {"audio_url": audio_url, "duration": duration, "chunk_timings": chunk_timings, "voice": voice}
+        for chunk in crossfade(segments()):
+            yield chunk.tobytes()
+        logger.info(f"Streamed {len(futures) + 1} sentences in {time.time() - start_time:.2f}s")
     except Exception as e:
-        logger.error(f"Error generating audio for '{text[:50]}...' with voice {voice}: {str(e)}")
-        raise
+        # Headers are already sent, so all we can do is end the stream early
+        logger.error(f"Error streaming audio for '{text[:50]}...' with voice {voice}: {str(e)}")
 
 @csrf_exempt
 def index(request):
@@ -109,18 +205,25 @@ def generate(request):
         if kokoro_pipeline is None:
             initialize_kokoro_pipeline()
 
-        # Generate audio for all sentences
-        results = []
-        output_dir = os.path.join(os.path.dirname(__file__), 'static', 'audio')
-        os.makedirs(output_dir, exist_ok=True)
+        # Queue every sentence at once so the pool can batch them
+        futures = []
         for i, (text, voice) in enumerate(zip(texts, voices)):
             text = text.strip()
             if not text:
                 continue
-            output_path = os.path.join(output_dir, f"{voice}_{hash(text + str(time.time()))}.wav")
-            logger.debug(f"Processing sentence {i+1}/{len(texts)}: '{text[:50]}...' with voice {voice}")
-            result = generate_audio_for_sentence(text, voice, output_path)
-            results.append(result)
+            logger.debug(f"Queueing sentence {i+1}/{len(texts)}: '{text[:50]}...' with voice {voice}")
+            futures.append((voice, submit_sentence(text, voice)))
+
+        # Write each file here in request order, keeping disk I/O off the inference worker
+        output_dir = os.path.join(os.path.dirname(__file__), 'static', 'audio')
+        os.makedirs(output_dir, exist_ok=True)
+        results = []
+        for voice, future in futures:
+            audio_segments = future.result(timeout=RESULT_TIMEOUT)
+            output_path = os.path.join(output_dir, f"{voice}_{next(_file_ctr)}_{secrets.token_hex(4)}.wav")
+            chunk_timings, duration = save_audio(audio_segments, output_path)
+            audio_url = f"/static/audio/{os.path.basename(output_path)}"
+            results.append({"audio_url": audio_url, "duration": duration, "chunk_timings": chunk_timings, "voice": voice})
 
         logger.info(f"Generated {len(results)} audio files in {time.time() - start_time:.2f}s")
         return JsonResponse({"audio_urls": results})
@@ -128,17 +231,58 @@ def generate(request):
         logger.error(f"Error in generate: {str(e)}")
         return JsonResponse({"error": str(e)}, status=500)
 
+@csrf_exempt
+def generate_stream(request):
+    """Stream audio for one text as a WAV, flushing each sentence as soon as it is ready."""
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=400)
+
+    text = (request.POST.get("text") or "").strip()
+    voice = request.POST.get("voice", "af_heart")
+    if not text:
+        logger.warning("No valid text provided")
+        return JsonResponse({"error": "No text provided"}, status=400)
+
+    try:
+        if kokoro_pipeline is None:
+            initialize_kokoro_pipeline()
+
+        # Resolve the voice and the first sentence before any bytes are sent, so failures get a proper status.
+        # Only fetch the voice file here; the pool worker owns loading it onto the device
+        ensure_voice(voice)
+        start_time = time.time()
+        sentences = split_sentences(text)
+        first_segments = submit_sentence(sentences[0], voice).result(timeout=RESULT_TIMEOUT)
+        if not first_segments:
+            raise RuntimeError("No audio segments generated")
+        logger.debug(f"Synthesized first sentence with voice {voice} in {time.time() - start_time:.2f}s")
+
+        futures = [submit_sentence(sentence, voice) for sentence in sentences[1:]]
+        return StreamingHttpResponse(stream_audio_for_text(text, voice, first_segments, futures), content_type="audio/wav")
+    except Exception as e:
+        logger.error(f"Error in generate_stream: {str(e)}")
+        return JsonResponse({"error": str(e)}, status=500)
+
+def remove_audio_files(audio_dir):
+    """Delete the generated .wav files in audio_dir."""
+    try:
+        with os.scandir(audio_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".wav") and entry.is_file():
+                    os.unlink(entry.path)
+        logger.debug("Audio folder cleaned up")
+    except FileNotFoundError:
+        logger.debug("No audio folder to clean up")
+    except Exception as e:
+        logger.error(f"Error cleaning up audio: {str(e)}")
+
 @csrf_exempt
 def cleanup_audio(request):
-    """Clean up audio files."""
+    """Clean up audio files in the background and respond immediately."""
     audio_dir = os.path.join(os.path.dirname(__file__), 'static', 'audio')
     try:
-        if os.path.exists(audio_dir):
-            for file in os.listdir(audio_dir):
-                if file.endswith(".wav"):
-                    os.remove(os.path.join(audio_dir, file))
-        logger.debug("Audio folder cleaned up")
-        return JsonResponse({"status": "success", "message": "Audio folder cleaned up"})
+        threading.Thread(target=remove_audio_files, args=(audio_dir,), name="audio-cleanup", daemon=True).start()
+        return JsonResponse({"status": "success", "message": "Audio folder cleanup started"})
     except Exception as e:
         logger.error(f"Error cleaning up audio: {str(e)}")
         return JsonResponse({"status": "error", "message": str(e)}, status=500)
\ No newline at end of file